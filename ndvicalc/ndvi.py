@@ -1,19 +1,100 @@
 from satsearch import Search
-from datetime import datetime, timedelta
-from json import load, JSONDecodeError
+from satstac import Item
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+import math
+import warnings
+from json import dump, dumps, JSONDecodeError
+from hashlib import sha256
+from time import time
+import os
+import sys
+from urllib.parse import urlparse
 from pyproj import Transformer
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import rasterio
-import rasterio.mask
-import rasterio.transform
+import numpy as np
 import numpy.ma as ma
-from rasterio.features import bounds
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, from_bounds
+from rasterio.transform import Affine
+from rasterio.enums import Resampling
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import ExitStack
 from tempfile import NamedTemporaryFile
 import matplotlib.pyplot as plt
-from rasterio.coords import BoundingBox
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from PIL import Image
+from shapely.geometry import shape, mapping
+from shapely import transform as transform_geometry
+from numba import njit, prange, set_num_threads
 import click
 
+try:
+    from orjson import loads as json_loads
+except ImportError:  # orjson is optional, fall back to the stdlib parser
+    from json import loads as json_loads
+
+
+# pooled session, repeated geoJSON downloads reuse the TLS connection
+_SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=3, backoff_factor=0.2)
+    )
+_SESSION.mount("https://", _ADAPTER)
+_SESSION.mount("http://", _ADAPTER)
+
+# fastmath without the nnan/ninf flags, nodata travels through as NaN,
+# reassoc lets LLVM vectorize the sums. The kernel compiles on its first
+# call, not at import: compiling a parallel kernel starts numba's thread
+# pool, which must not exist yet when the CLI batch mode forks its workers.
+@njit(parallel=True, fastmath={"arcp", "reassoc", "contract"}, cache=True)
+def _ndvi_stats(nir, red, out):
+    '''
+    Computes NDVI for 2D float32 bands row-parallel into out and returns
+    count, sum, sum of squares, min and max of the non NaN values in the
+    same pass, pixels where nir+red is zero are set to NaN
+    '''
+    count = 0
+    total = 0.0
+    total_sq = 0.0
+    minimum = np.inf
+    maximum = -np.inf
+    for i in prange(nir.shape[0]):
+        for j in range(nir.shape[1]):
+            n = nir[i, j]
+            r = red[i, j]
+            s = n + r
+            if s != 0:
+                value = (n - r) / s
+            else:
+                value = np.float32(np.nan)
+            out[i, j] = value
+            if not np.isnan(value):
+                value64 = np.float64(value)
+                count += 1
+                total += value64
+                total_sq += value64 * value64
+                minimum = min(minimum, value64)
+                maximum = max(maximum, value64)
+    return count, total, total_sq, minimum, maximum
+
+@lru_cache(maxsize=64)
+def _get_transformer(src_crs:str, dst_crs:str):
+    '''
+    Returns a cached (lon, lat) ordered transformer, both bands
+    of a Sentinel-2 tile share the same CRS
+    '''
+    return Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+class NDVIError(Exception):
+    '''
+    Raised when the NDVI can not be calculated for a geoJSON file
+    '''
+
 class NDVICalc():
 
     def __init__(self):
@@ -30,11 +111,36 @@ class NDVICalc():
             As CLI:
                 ndvicalc --file /path/to/file [options]
                     --file      Path or url
+                    --paths-file    Text file with one path or url per line
                     --full      Full statistics (max,min,std)
                     --plot      Render a matplotlib plot of the AOI
+                    --save      Save the NDVI of the AOI as grayscale PNG
         '''
         self.SAT_API = 'https://earth-search.aws.element84.com/v0'
+        # STAC search results are cached on disk for CACHE_TTL seconds
+        self.CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "ndvicalc", "stac")
+        self.CACHE_TTL = 6 * 60 * 60
+        # max. pixels across the kept/plotted NDVI array, larger areas are
+        # block averaged, the statistics always use every pixel read
+        self.MAX_PIXELS = 2048
+        # GDAL options for reading the remote COGs with as few
+        # range requests as possible
+        self.GDAL_ENV = {
+            'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR',
+            'CPL_VSIL_CURL_USE_HEAD': 'NO',
+            'CPL_VSIL_CURL_ALLOWED_EXTENSIONS': '.tif,.TIF,.tiff',
+            'GDAL_INGESTED_BYTES_AT_OPEN': '32768',
+            'GDAL_HTTP_MERGE_CONSECUTIVE_RANGES': 'YES',
+            'GDAL_HTTP_MULTIPLEX': 'YES',
+            'GDAL_HTTP_VERSION': '2',
+            'VSI_CACHE': 'TRUE',
+            'VSI_CACHE_SIZE': str(64 << 20),  # 64 MB per file handle
+            'GDAL_CACHEMAX': 512,  # MB
+            # decode the deflate compressed COG tiles of a block in parallel
+            'GDAL_NUM_THREADS': 'ALL_CPUS'
+        }
         self.latest_data = None
+        self._result_key = None
         
         self.ndvi_array = None
         self.ndvi_avg = None
@@ -42,67 +148,161 @@ class NDVICalc():
         self.ndvi_min = None
         self.ndvi_std = None
 
-    def _get_file_geometry(self, file_path:str):
+    def _get_file_geometry(self, file_path:str, silent:bool=False):
         ''' Parses geoJSON and returns the geometry
 
         Args:
             file_path: str, path to geoJSON or URL
 
+        Optional:
+            silent: bool, do not print any messages
+
         Returns:
             file_content: dict, geometry of given geoJSON
         '''
 
         # check if url or path is given
         try:
-            if "http" in file_path or "https" in file_path:
-                resp = requests.get(file_path)
+            if urlparse(file_path).scheme in ("http", "https"):
+                try:
+                    resp = _SESSION.get(file_path, timeout=10)
+                except requests.RequestException:
+                    if not silent:
+                        print(f"File with url {file_path} can not be reached.")
+                    return None
                 if resp.status_code == 200:
-                    file_content = resp.json()
+                    file_content = json_loads(resp.content)
                 else:
-                    print(f"File with url {file_path} can not be reached.")
+                    if not silent:
+                        print(f"File with url {file_path} can not be reached.")
                     return None
             else:
-                with open(file_path,"r") as fp:
-                    file_content = load(fp)
+                with open(file_path,"rb") as fp:
+                    file_content = json_loads(fp.read())
             # parse content
             if file_content["type"] == "Feature":
                 file_content = file_content["geometry"]
             elif file_content["type"] == "FeatureCollection":
                 if len(file_content["features"]) > 1:
-                    print("Found more than 1 feature, avoid this. Using feature #1")
+                    if not silent:
+                        print("Found more than 1 feature, avoid this. Using feature #1")
                 file_content = file_content["features"][0]["geometry"]
             return file_content
         except JSONDecodeError:
-            print("Provided json file is not valid.")
+            if not silent:
+                print("Provided json file is not valid.")
             return None
     
-    def _get_ndvi(self, nir, red):
+    def _get_ndvi(self, nir, red, out=None):
         '''
         Calculates NDVI for given nir and red bands
         
         Args:
             nir: float or np.array, near infrared band
             red: float or np.array, red band
+
+        Optional:
+            out: np.array, float32 array with the shape of the bands the
+                result is written to, passing nir computes NDVI in place
         
         Returns:
-            ndvi: float or np.array, normalized difference vegetation index
+            ndvi: float or np.array, normalized difference vegetation index,
+                NaN where a band is masked or has no signal
 
         NDVI is defined as (nir-red)/(nir+red)
         '''
-        if not isinstance(nir, float):
-            nir = nir.astype(float)
-        if not isinstance(red, float):
-            red = red.astype(float)
-        return (nir-red)/(nir+red)
+        if isinstance(nir, float) and isinstance(red, float):
+            return (nir-red)/(nir+red)
+
+        # float32 is plenty for a ratio bounded by [-1, 1] and halves the
+        # memory traffic compared to float64, masked pixels become NaN
+        nir, red = np.broadcast_arrays(
+            ma.asarray(nir, dtype=np.float32).filled(np.nan),
+            ma.asarray(red, dtype=np.float32).filled(np.nan)
+            )
+        shape = nir.shape
+        nir = np.ascontiguousarray(np.atleast_2d(nir))
+        red = np.ascontiguousarray(np.atleast_2d(red))
+        # same kernel as the block streaming, the statistics are not needed
+        if out is None:
+            ndvi = np.empty_like(nir)
+            _ndvi_stats(nir, red, ndvi)
+            return ndvi.reshape(shape)
+        # every pixel is read before it is written, so out may be nir
+        _ndvi_stats(nir, red, np.atleast_2d(out))
+        return out
+
+    def _downsample(self, array, factor:int):
+        '''
+        Downsamples a 2D array by averaging factor x factor blocks
+
+        Args:
+            array: np.array, 2D array, NaN values are ignored
+            factor: int, edge length of the averaged blocks
 
-    def get_latest_sentinel_files(self, geometry:dict):
+        Returns:
+            array: np.array, array with shape // factor
+        '''
+        if factor <= 1:
+            return array
+        rows = array.shape[0] // factor
+        cols = array.shape[1] // factor
+        blocks = array[:rows*factor, :cols*factor].reshape(rows, factor, cols, factor)
+        with warnings.catch_warnings():
+            # blocks outside of the geometry are all NaN and stay NaN
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            return np.nanmean(blocks, axis=(1, 3))
+
+    def _accumulate_block(self, sums, counts, ndvi, rows, cols, factor:int):
+        '''
+        Adds a block to the sums & counts of a factor x factor block
+        averaged array, blocks do not have to be aligned to factor
+
+        Args:
+            sums: np.array, sum of the non NaN values per averaged pixel
+            counts: np.array, number of non NaN values per averaged pixel
+            ndvi: np.array, 2D block of NDVI values
+            rows: slice, rows of the block in the full array
+            cols: slice, cols of the block in the full array
+            factor: int, edge length of the averaged blocks
+        '''
+        valid = ~np.isnan(ndvi)
+        row_cells = np.arange(rows.start, rows.stop) // factor
+        col_cells = np.arange(cols.start, cols.stop) // factor
+        # first row & col of every averaged pixel inside of the block
+        row_starts = np.flatnonzero(np.diff(row_cells, prepend=-1))
+        col_starts = np.flatnonzero(np.diff(col_cells, prepend=-1))
+        cells = (
+            slice(row_cells[0], row_cells[-1] + 1),
+            slice(col_cells[0], col_cells[-1] + 1)
+            )
+        for total, values in (
+            (sums, np.where(valid, ndvi, 0.0)), 
+            (counts, valid.astype(np.int32))
+            ):
+            total[cells] += np.add.reduceat(
+                np.add.reduceat(values, row_starts, axis=0), 
+                col_starts, 
+                axis=1
+                )
+
+    def get_latest_sentinel_files(self, geometry:dict, silent:bool=False):
         ''' Get urls of latest sentinel nir & red band for given geometry
 
             Args:
                 geometry: python dict of geoJSON geometry
 
+            Optional:
+                silent: bool, do not print any messages
+
             Returns:
                 dict: {"nir":$url, "red":$url} dict with with urls of latest cog's
+
+            Raises:
+                NDVIError: if no data was found for the geometry
+
+            Results are cached in CACHE_DIR for CACHE_TTL seconds, expired
+            entries are removed whenever a new one is written.
         '''
         
         # search last 90 days
@@ -117,28 +317,361 @@ class NDVICalc():
                     "lt": 20
                     }
                 }
+
+        # answer repeated searches for the same geometry from disk
+        cache_key = sha256(
+            (
+            dumps(geometry, sort_keys=True) 
+            + date_90_days_ago 
+            + current_date 
+            + dumps(query, sort_keys=True)
+            ).encode()
+            ).hexdigest()
+        cache_file = os.path.join(self.CACHE_DIR, f"{cache_key}.json")
+        try:
+            if time() - os.path.getmtime(cache_file) < self.CACHE_TTL:
+                with open(cache_file, "rb") as fp:
+                    cached = json_loads(fp.read())
+                self.latest_data = date.fromisoformat(cached["date"])
+                if not silent:
+                    print("Latest data found that intersects geometry:", self.latest_data)
+                return {"red":cached["red"], "nir":cached["nir"]}
+        except (OSError, JSONDecodeError, KeyError, ValueError):
+            pass  # no valid cache entry, search again
+
         search = Search(
             url=self.SAT_API,
             intersects=geometry,
             datetime=date_90_days_ago + "/" + current_date,
             collections=['sentinel-s2-l2a-cogs'],
-            query=query
+            query=query,
+            sortby=[{"field": "properties.datetime", "direction": "desc"}],
+            limit=1
             )        
-        # grep latest red && nir
-        items = search.items()
-        self.latest_data = items.dates()[-1]
-        red = items[0].asset('red')["href"]
-        nir = items[0].asset('nir')["href"]
-        print("Latest data found that intersects geometry:", self.latest_data)
+        # grep latest red && nir, the api sorts by date so one item is enough.
+        # The search is posted directly, items() would first count all
+        # matches, warn that there are more than the limit of 1 and
+        # fetch the collection in 2 extra requests.
+        features = search.query(**search.kwargs)["features"]
+        if len(features) == 0:
+            raise NDVIError("No Sentinel-2 data with less than 20% cloud cover found in the last 90 days.")
+        item = Item(features[0])
+        self.latest_data = item.date
+        # the earth-search v0 items key their assets by band id (B04, B08),
+        # asset() also resolves the common names red & nir
+        red = item.asset('red')["href"]
+        nir = item.asset('nir')["href"]
+        if not silent:
+            print("Latest data found that intersects geometry:", self.latest_data)
+
+        # write to a temporary file first, so concurrent readers
+        # never see a partial cache entry
+        try:
+            os.makedirs(self.CACHE_DIR, exist_ok=True)
+            with NamedTemporaryFile("w", dir=self.CACHE_DIR, suffix=".tmp", delete=False) as fp:
+                dump({"date":self.latest_data.isoformat(), "red":red, "nir":nir}, fp)
+            os.replace(fp.name, cache_file)
+            # the keys contain the search dates, so expired entries are
+            # never read again, remove them instead of letting them pile up
+            for entry in os.scandir(self.CACHE_DIR):
+                if time() - entry.stat().st_mtime >= self.CACHE_TTL:
+                    os.remove(entry.path)
+        except OSError:
+            pass  # caching is best effort
 
         return {"red":red, "nir":nir}
 
+    def _open_band(self, url:str):
+        '''
+        Opens a band COG
+
+        Args:
+            url: str, url of the band COG
+
+        Returns:
+            url_fp: rasterio dataset of the band COG
+        '''
+        # GDAL config options are thread local, so every worker enters its own env
+        with rasterio.Env(**self.GDAL_ENV):
+            return rasterio.open(url)
+
+    def _get_read_window(self, url_fp, geometry:dict, target_resolution:float=10.0):
+        '''
+        Calculates the window of a band COG that covers the geometry
+
+        Args:
+            url_fp: rasterio dataset of the band COG
+            geometry: dict, geoJSON geometry in EPSG:4326
+
+        Optional:
+            target_resolution: float, coarsest pixel size in meters the caller needs
+
+        Returns:
+            shapes: list, geometry in the crs of the COG
+            window: rasterio.windows.Window, pixels to be streamed
+            factor: int, overview factor the window is read with
+        '''
+        coord_transformer = _get_transformer("epsg:4326", url_fp.crs.to_string())
+
+        # Reproject the geometry instead of the raster, this way the
+        # COG is cropped & masked in its native crs without a warped
+        # copy on disk. All vertices go through PROJ in a single call.
+        geometry_src = transform_geometry(
+            shape(geometry),
+            lambda coords: np.column_stack(
+                coord_transformer.transform(coords[:, 0], coords[:, 1])
+                )
+            )
+        shapes = [mapping(geometry_src)]
+
+        # calculate pixels to be streamed in cog, the window is
+        # snapped outwards to whole pixels in one affine inversion
+        window = from_bounds(*geometry_src.bounds, transform=url_fp.transform)
+        row_start = math.floor(window.row_off)
+        col_start = math.floor(window.col_off)
+        row_stop = math.ceil(window.row_off + window.height)
+        col_stop = math.ceil(window.col_off + window.width)
+
+        # If a pixel value (or the remaining pixels) is below 0, that
+        # means that the bounds are not inside of our available dataset.
+        if min(
+            row_start, 
+            col_start, 
+            url_fp.height - row_stop, 
+            url_fp.width - col_stop
+            ) < 0:
+            raise NDVIError(
+                "Provided geometry extends available datafile. "
+                "Provide a smaller area of interest to get a result."
+                )
+
+        window = Window.from_slices((row_start, row_stop), (col_start, col_stop))
+
+        # For coarse target resolutions read from the COG overviews instead
+        # of the full 10 m resolution, GDAL picks the overview level that
+        # matches the requested out_shape
+        resolution = url_fp.res[0]
+        factor = int(max(target_resolution, resolution) // resolution)
+        return shapes, window, factor
+
+    def _iter_blocks(self, window, factor:int, block_shape:tuple):
+        '''
+        Splits a window into blocks, so only one block per band
+        has to be held in memory. The blocks are aligned to the
+        block_shape grid of the COG, so a block read starts on an
+        internal tile instead of cutting four tiles
+
+        Args:
+            window: rasterio.windows.Window, pixels to be streamed
+            factor: int, overview factor the window is read with
+            block_shape: tuple, (rows, cols) of a block in output pixels,
+                a multiple of the internal tile size of the COG
+
+        Yields:
+            rows: slice, rows of the block in the output array
+            cols: slice, cols of the block in the output array
+            block: rasterio.windows.Window, window of the block in the COG
+        '''
+        height = max(1, window.height // factor)
+        width = max(1, window.width // factor)
+        row_edges = self._block_edges(window.row_off, height, block_shape[0], factor)
+        col_edges = self._block_edges(window.col_off, width, block_shape[1], factor)
+        for row, row_end in zip(row_edges[:-1], row_edges[1:]):
+            # the last block also covers the pixels that do not fill a whole factor
+            row_stop = row_end * factor if row_end < height else window.height
+            for col, col_end in zip(col_edges[:-1], col_edges[1:]):
+                col_stop = col_end * factor if col_end < width else window.width
+                block = Window(
+                    window.col_off + col * factor,
+                    window.row_off + row * factor,
+                    col_stop - col * factor,
+                    row_stop - row * factor
+                    )
+                yield slice(row, row_end), slice(col, col_end), block
+
+    def _block_edges(self, offset:int, length:int, size:int, factor:int):
+        '''
+        Returns the block edges along one axis of the output array
+
+        Args:
+            offset: int, offset of the window in the COG
+            length: int, output pixels along the axis
+            size: int, output pixels per block
+            factor: int, overview factor the window is read with
+
+        Returns:
+            edges: list, block edges in output pixels from 0 to length
+        '''
+        # output pixels up to the next tile boundary of the COG
+        first = (-offset) % (size * factor) // factor
+        return [0] + [edge for edge in range(first, length, size) if edge > 0] + [length]
+
+    def _read_block(self, url_fp, window, out_shape:tuple, shapes:list):
+        '''
+        Reads a block of a band COG
+
+        Args:
+            url_fp: rasterio dataset of the band COG
+            window: rasterio.windows.Window, window of the block
+            out_shape: tuple, shape the block is read with
+            shapes: list, geometry in the crs of the COG
+
+        Returns:
+            band: np.array, float32 band values, NaN outside of the geometry
+                and for nodata pixels
+        '''
+        with rasterio.Env(**self.GDAL_ENV):
+            # let GDAL convert to float32 while reading, no uint16 copy
+            band = url_fp.read(
+                1, 
+                window=window, 
+                out_shape=out_shape, 
+                out_dtype=np.float32,
+                resampling=Resampling.average
+                )
+        band_transform = url_fp.window_transform(window) * Affine.scale(
+            window.width / out_shape[1],
+            window.height / out_shape[0]
+            )
+
+        # keep pixels outside of the geometry or without data as NaN instead
+        # of a masked array, plain ndarray reductions are much faster
+        invalid = geometry_mask(shapes, out_shape, band_transform)
+        if url_fp.nodata is not None:
+            invalid |= band == url_fp.nodata
+        band[invalid] = np.nan
+        return band
+
+    def _read_blocks(self, executor, datasets:tuple, blocks, shapes:list):
+        '''
+        Reads blocks of all bands concurrently, the next block is
+        requested while the current one is processed
+
+        Args:
+            executor: concurrent.futures.Executor, pool the reads run on
+            datasets: tuple, rasterio datasets of the band COGs
+            blocks: iterable, blocks as yielded by _iter_blocks
+            shapes: list, geometry in the crs of the COGs
+
+        Yields:
+            rows: slice, rows of the block in the output array
+            cols: slice, cols of the block in the output array
+            bands: list, block of every dataset, see _read_block
+        '''
+        pending = None
+        for rows, cols, block in blocks:
+            if pending is not None:
+                # a dataset must not be read by two threads at once, so
+                # wait for the previous block before requesting this one
+                done = (pending[0], pending[1], [future.result() for future in pending[2]])
+            out_shape = (rows.stop - rows.start, cols.stop - cols.start)
+            futures = [
+                executor.submit(self._read_block, band_fp, block, out_shape, shapes)
+                for band_fp in datasets
+                ]
+            if pending is not None:
+                yield done
+            pending = (rows, cols, futures)
+        if pending is not None:
+            yield pending[0], pending[1], [future.result() for future in pending[2]]
+
+    def _materialize_ndvi(
+        self, 
+        file_path:str, 
+        keep_array:bool=False, 
+        target_resolution_m:float=10.0,
+        silent:bool=False
+        ):
+        '''
+        Streams the NDVI for given geoJSON file and sets the statistics,
+        see calc_ndvi for the arguments
+        '''
+        geometry = self._get_file_geometry(file_path, silent)
+        if geometry is None:
+            raise NDVIError("Provided geometry is invalid.")
+
+        latest_data = self.get_latest_sentinel_files(geometry, silent)
+        self.ndvi_array = None
+        # the pool is left first, so no read is still running on a
+        # worker thread when the datasets are closed
+        with ExitStack() as stack, ThreadPoolExecutor(max_workers=2) as executor:
+            # open & stream the 2 bands (nir & red) concurrently, both are io bound
+            nir_future = executor.submit(self._open_band, latest_data["nir"])
+            red_future = executor.submit(self._open_band, latest_data["red"])
+            # close the band that did open, if opening the other one failed
+            wait((nir_future, red_future))
+            for future in (nir_future, red_future):
+                if future.exception() is None:
+                    stack.enter_context(future.result())
+            nir_fp = nir_future.result()
+            red_fp = red_future.result()
+
+            # both bands share the 10 m grid of the Sentinel-2 tile
+            shapes, window, factor = self._get_read_window(
+                nir_fp, 
+                geometry, 
+                target_resolution_m
+                )
+            height = max(1, window.height // factor)
+            width = max(1, window.width // factor)
+            # the kept array is block averaged down to MAX_PIXELS, the
+            # statistics below still see every pixel that is read
+            array_factor = max(1, math.ceil(max(height, width) / self.MAX_PIXELS))
+            if keep_array and array_factor == 1:
+                # at most MAX_PIXELS x MAX_PIXELS float32, fits in RAM
+                self.ndvi_array = np.empty((height, width), dtype=np.float32)
+            elif keep_array:
+                array_shape = (math.ceil(height / array_factor), math.ceil(width / array_factor))
+                sums = np.zeros(array_shape, dtype=np.float64)
+                counts = np.zeros(array_shape, dtype=np.int32)
+            block_shape = tuple(max(512, size) for size in nir_fp.block_shapes[0])
+
+            # calculate ndvi & running statistics block by block
+            count, total, total_sq = 0, 0.0, 0.0
+            ndvi_min, ndvi_max = np.inf, -np.inf
+            blocks = self._iter_blocks(window, factor, block_shape)
+            for rows, cols, (nir, red) in self._read_blocks(
+                executor, 
+                (nir_fp, red_fp), 
+                blocks, 
+                shapes
+                ):
+                # ndvi & statistics in one pass over the block, the nir
+                # block is not needed afterwards, so reuse its buffer
+                block_count, block_total, block_total_sq, block_min, block_max = _ndvi_stats(nir, red, nir)
+                if self.ndvi_array is not None:
+                    self.ndvi_array[rows, cols] = nir
+                elif keep_array:
+                    self._accumulate_block(sums, counts, nir, rows, cols, array_factor)
+
+                count += block_count
+                total += block_total
+                total_sq += block_total_sq
+                ndvi_min = min(ndvi_min, block_min)
+                ndvi_max = max(ndvi_max, block_max)
+
+        if keep_array and self.ndvi_array is None:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                # averaged pixels without any value stay NaN
+                self.ndvi_array = (sums / counts).astype(np.float32)
+
+        if count:
+            self.ndvi_avg = total / count
+            self.ndvi_max = ndvi_max
+            self.ndvi_min = ndvi_min
+            self.ndvi_std = math.sqrt(max(total_sq / count - self.ndvi_avg ** 2, 0.0))
+        else:
+            self.ndvi_avg = self.ndvi_max = self.ndvi_min = self.ndvi_std = np.nan
+
     def calc_ndvi(
         self, 
         file_path:str, 
         full_statistics:bool=False,
         show_plot:bool=False,
-        silent:bool=False
+        silent:bool=False,
+        keep_array:bool=False,
+        target_resolution_m:float=10.0,
+        save_path:str=None
         ):
         '''
         Calculates NDVI for given geoJSON file
@@ -149,134 +682,113 @@ class NDVICalc():
         Optional:
             full_statistics: bool, returns full statistics (max=maximum, min=minimum, std=standard deviation)
             show_plot: bool, if True, render a matplotlib plot
-            silent: do not print any messages
+            silent: bool, do not print any messages
+            keep_array: bool, if True, keep the NDVI array in self.ndvi_array,
+                block averaged to at most MAX_PIXELS across, otherwise only
+                the statistics are computed block by block
+            target_resolution_m: float, pixel size in meters, values above 10
+                read averaged pixels from the COG overviews
+            save_path: str, if set, save the NDVI as grayscale PNG to this path,
+                black is -1 and outside of the geometry, white is 1
+
+        Raises:
+            NDVIError: if the geometry is invalid, extends the available data
+                or no data was found
         '''
 
-        geometry = self._get_file_geometry(file_path)
-        if geometry is None:
-            print("Provided geometry is invalid. Aborting...")
-            exit()
-        else:
-            bbox = bounds(geometry)
-            latest_data = self.get_latest_sentinel_files(geometry)
-            ndvi_data = {}
-            # iterate the 2 bands (nir & red)
-            for file_url in latest_data:
-                with rasterio.open(latest_data[file_url]) as url_fp:
-                    coord_transformer = Transformer.from_crs("epsg:4326", url_fp.crs) 
-
-                    # calculate pixels to be streamed in cog 
-                    coord_upper_left = coord_transformer.transform(bbox[3], bbox[0])
-                    coord_lower_right = coord_transformer.transform(bbox[1], bbox[2])            
-                    pixel_upper_left = url_fp.index(
-                        coord_upper_left[0], 
-                        coord_upper_left[1]
-                        )
-                    pixel_lower_right = url_fp.index(
-                        coord_lower_right[0], 
-                        coord_lower_right[1]
-                        )
-                    
-                    for pixel in pixel_upper_left + pixel_lower_right:
-                        # If the pixel value is below 0, that means that
-                        # the bounds are not inside of our available dataset.
-                        if pixel < 0:
-                            print("Provided geometry extends available datafile.")
-                            print("Provide a smaller area of interest to get a result.")
-                            exit()
-
-                    # make http range request only for bytes in window
-                    window = rasterio.windows.Window.from_slices(
-                            (
-                            pixel_upper_left[0], 
-                            pixel_lower_right[0]
-                            ), 
-                            (
-                            pixel_upper_left[1], 
-                            pixel_lower_right[1]
-                            )
-                        )
-                    subset = url_fp.read(1, window=window)
-
-                    # prepare transform and metadata for reprojection
-                    subset_transform = rasterio.transform.from_origin(
-                        coord_upper_left[0], 
-                        coord_upper_left[1], 
-                        10,  # Band 4 and 8 are having 10 meter spartial resolution
-                        10   # per pixel according to https://sentinels.copernicus.eu/web/sentinel/missions/sentinel-2/instrument-payload/resolution-and-swath
-                        )           
-                    dst_crs = 'EPSG:4326'                
-                    transform, width, height = calculate_default_transform(
-                        url_fp.crs, 
-                        dst_crs, 
-                        subset.shape[1], 
-                        subset.shape[0], 
-                        *BoundingBox(
-                            coord_upper_left[0],
-                            coord_upper_left[1], 
-                            coord_lower_right[0], 
-                            coord_lower_right[1]
-                            )
-                        )
-                    kwargs = url_fp.meta.copy()
-                    kwargs.update({
-                        'crs': dst_crs,
-                        'transform': transform,
-                        'width': width,
-                        'height': height
-                    })
-                    # open a memory file to avoid using disk space
-                    with NamedTemporaryFile() as tmp:
-                        with rasterio.open(
-                            tmp.name, 
-                            'w', 
-                            **kwargs
-                            ) as subset_fp:
-                            # Warp file to EPSG:4326 since rasterio throws an error when
-                            # trying to call rasterio.mask.mask() with a geoJSON with crs
-                            # EPSG:32633. Will investigate further...
-                            reproject(
-                                source=subset,
-                                destination=rasterio.band(subset_fp, 1),
-                                src_transform=subset_transform,
-                                src_crs=url_fp.crs,
-                                dst_transform=transform,
-                                dst_crs=dst_crs,
-                                resampling=Resampling.nearest)
-                        with rasterio.open(tmp.name) as tmp:
-                            # mask the exact shape to receive an accurate result
-                            out_img, _ = rasterio.mask.mask(tmp, [geometry], crop=True)                        
-                            # mask all masked (e.g nodata) values
-                            ndvi_data[file_url] = ma.masked_invalid(out_img[0])
-                            
-            # calculate ndvi & statistics
-            self.ndvi_array = self._get_ndvi(ndvi_data["nir"], ndvi_data["red"])
-            self.ndvi_avg = self.ndvi_array.mean()
-            print(f"{self.latest_data} Average ndvi", self.ndvi_avg)
+        # the instance still holds the result of the last call, the same
+        # file on the same day does not need to be downloaded again
+        result_key = (file_path, date.today(), target_resolution_m)
+        needs_array = keep_array or show_plot or save_path is not None
+        if result_key != self._result_key or (needs_array and self.ndvi_array is None):
+            self._result_key = None
+            self._materialize_ndvi(file_path, needs_array, target_resolution_m, silent)
+            self._result_key = result_key
 
-            if full_statistics:
-                self.ndvi_max = self.ndvi_array.max()
-                self.ndvi_min = self.ndvi_array.min()
-                self.ndvi_std = self.ndvi_array.std()
-                print(f"{self.latest_data} Max ndvi", self.ndvi_max)
-                print(f"{self.latest_data} Min ndvi", self.ndvi_min)
-                print(f"{self.latest_data} Std ndvi", self.ndvi_std)
-            if show_plot:
-                plt.imshow(self.ndvi_array, cmap="seismic")
-                plt.title(f"NDVI at {self.latest_data}")
-                plt.colorbar()
-                plt.show()
+        if not silent:
+            print(f"{self.latest_data} Average ndvi", self.ndvi_avg)
+        if full_statistics and not silent:
+            print(f"{self.latest_data} Max ndvi", self.ndvi_max)
+            print(f"{self.latest_data} Min ndvi", self.ndvi_min)
+            print(f"{self.latest_data} Std ndvi", self.ndvi_std)
+        if save_path is not None:
+            # write the pixels directly, no matplotlib figure is rendered
+            gray = np.clip(self.ndvi_array * 127 + 128, 0, 255)
+            np.nan_to_num(gray, copy=False, nan=0)
+            Image.fromarray(gray.astype(np.uint8)).save(save_path, optimize=True)
+        if show_plot:
+            # the figure is only a few hundred pixels wide, so downsample
+            # large areas before matplotlib allocates the rgba image
+            canvas = max(plt.rcParams["figure.figsize"]) * plt.rcParams["figure.dpi"]
+            factor = int(max(self.ndvi_array.shape) // canvas)
+            # NDVI is bounded, a fixed color range spares matplotlib the
+            # min/max scan and keeps plots of different dates comparable
+            plt.imshow(
+                self._downsample(self.ndvi_array, factor), 
+                cmap="seismic", 
+                vmin=-1, 
+                vmax=1, 
+                interpolation="nearest"
+                )
+            plt.title(f"NDVI at {self.latest_data}")
+            plt.colorbar()
+            plt.show()
        
+def _init_worker():
+    '''
+    Limits a worker process of the CLI batch mode to one numba thread,
+    the workers already run in parallel on every cpu
+    '''
+    set_num_threads(1)
+
+def _calc_one(file_path:str):
+    '''
+    Calculates NDVI for one geoJSON file in a worker process of the CLI batch mode
+
+    Returns:
+        file_path: str, path or URL of the geoJSON file
+        statistics: tuple, (avg, max, min, std) or None if the file could not be processed
+        error: str, reason why the file could not be processed or None
+    '''
+    try:
+        calc = NDVICalc()
+        # one thread per worker, see _init_worker
+        calc.GDAL_ENV["GDAL_NUM_THREADS"] = "1"
+        calc.calc_ndvi(file_path=file_path, silent=True)
+        return file_path, (calc.ndvi_avg, calc.ndvi_max, calc.ndvi_min, calc.ndvi_std), None
+    except Exception as error:
+        # skip this file instead of the whole batch
+        return file_path, None, str(error) or type(error).__name__
+
 # create cli
 @click.command()
 @click.option("--example", is_flag=True, help="Run Berlin Doberitzer Heide example")
 @click.option('--file', help="Path or url to geoJSON file with geometry")
+@click.option('--paths-file', help="Text file with one path or url to a geoJSON file per line")
 @click.option('--full', is_flag=True, help="Print full statistics (max, min, std)")
 @click.option('--plot', is_flag=True, help='Render plot of NDVI at given geometry')
-def cli(example, file, full, plot):
+@click.option('--save', help='Save NDVI at given geometry as grayscale PNG to this path')
+def cli(example, file, paths_file, full, plot, save):
     '''
     Calculate the NDVI from geoJSON files from path or URL by using open Sentinel-2 data
     '''
+    if paths_file:
+        with open(paths_file, "r") as fp:
+            file_paths = [line.strip() for line in fp if line.strip()]
+        # one process per area of interest, the imports are paid once per
+        # worker and the STAC searches are shared through the disk cache
+        with ProcessPoolExecutor(
+            max_workers=os.cpu_count(), 
+            initializer=_init_worker
+            ) as executor:
+            for file_path, statistics, error in executor.map(_calc_one, file_paths):
+                if statistics is None:
+                    print(f"{file_path}, skipped: {error}")
+                elif full:
+                    print(f"{file_path}, " + ", ".join(str(value) for value in statistics))
+                else:
+                    print(f"{file_path}, {statistics[0]}")
+        return
     calc = NDVICalc()
     if example:
         print("Using example doberitzer_heide.geojson")
@@ -284,7 +796,11 @@ def cli(example, file, full, plot):
     if not file:
         print("A path or url is required. Type 'ndvicalc --help' for help.")
     else:
-        calc.calc_ndvi(file_path=file, full_statistics=full, show_plot=plot)
+        try:
+            calc.calc_ndvi(file_path=file, full_statistics=full, show_plot=plot, save_path=save)
+        except NDVIError as error:
+            print(error)
+            sys.exit(1)
     
 if __name__ == "__main__":
     cli()
\ No newline at end of file
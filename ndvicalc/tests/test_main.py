@@ -1,19 +1,50 @@
 from pathlib import Path  
 import unittest
+import numpy as np
 import json
 import sys  
 import re
+import os
+import subprocess
+import time
+from datetime import date
+from tempfile import TemporaryDirectory, mkdtemp
+from PIL import Image
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from unittest import mock
 
 file = Path(__file__).resolve()  
 package_root_directory = file.parents [1]  
 sys.path.append(str(package_root_directory))  
 
-from ndvi import NDVICalc
+from ndvi import NDVICalc, NDVIError, _ndvi_stats
 ndvicalc = NDVICalc()
 
 EXAMPLE_URL  = "https://gist.githubusercontent.com/rodrigoalmeida94/369280ddccf97763da54371199a9acea/raw/d18cd1e266023d08464e13bf0e239ee29175e592/doberitzer_heide.geojson"
 EXAMPLE_PATH = "./example/doberitzer_heide.geojson"
 CORRUPT_PATH = "./example/corrupt.geojson"
+URL_RE = re.compile(  # credit: django https://github.com/django/django/blob/stable/1.3.x/django/core/validators.py#L45
+    r'^(?:http|ftp)s?://' # http:// or https://
+    r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|' #domain...
+    r'localhost|' #localhost...
+    r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})' # ...or ip
+    r'(?::\d+)?' # optional port
+    r'(?:/?|[/?]\S+)$', re.IGNORECASE)
+
+def setUpModule():
+    '''
+    Keeps the STAC search cache of the tests out of the home
+    directory, every test run searches live again
+    '''
+    global cache_directory
+    cache_directory = TemporaryDirectory()
+    ndvicalc.CACHE_DIR = cache_directory.name
+
+def tearDownModule():
+    cache_directory.cleanup()
 
 class TestNDVICalc(unittest.TestCase):        
 
@@ -43,6 +74,14 @@ class TestNDVICalc(unittest.TestCase):
         geometry = ndvicalc._get_file_geometry(CORRUPT_PATH)
         self.assertEqual(geometry, None, "Invalid geoJSON has been passed.")
 
+    def test_calc_ndvi_corrupt(self):
+        '''
+        Test if NDVIError is raised instead of exiting
+        when passing a wrong/corrupt geoJSON
+        '''
+        with self.assertRaises(NDVIError):
+            NDVICalc().calc_ndvi(CORRUPT_PATH)
+
     def test_get_ndvi(self):
         '''
         Test NDVI calculation: NDVI = (nir-red)/(nir+red)
@@ -50,6 +89,242 @@ class TestNDVICalc(unittest.TestCase):
         ndvi_value = ndvicalc._get_ndvi(42.0,32.0)
         self.assertAlmostEqual(ndvi_value, 0.13513513513513514, 5, "NDVI calculation is broken.")
 
+    def test_get_ndvi_array(self):
+        '''
+        Test NDVI calculation on band arrays, pixels
+        without signal in both bands have to be masked
+        '''
+        nir = np.array([[42, 0], [100, 50]], dtype=np.uint16)
+        red = np.array([[32, 0], [0, 50]], dtype=np.uint16)
+        ndvi_array = ndvicalc._get_ndvi(nir, red)
+        self.assertEqual(ndvi_array.dtype, np.float32, "NDVI array is not float32.")
+        self.assertTrue(np.isnan(ndvi_array[0, 1]), "Nodata pixel has not been masked.")
+        self.assertAlmostEqual(ndvi_array[0, 0], 0.13513513513513514, 5, "NDVI calculation is broken.")
+        self.assertAlmostEqual(ndvi_array[1, 0], 1.0, 5, "NDVI calculation is broken.")
+        self.assertAlmostEqual(ndvi_array[1, 1], 0.0, 5, "NDVI calculation is broken.")
+
+        # in place into the nir band
+        nir = nir.astype(np.float32)
+        ndvi_array = ndvicalc._get_ndvi(nir, red, out=nir)
+        self.assertIs(ndvi_array, nir, "NDVI has not been written to out.")
+        self.assertAlmostEqual(ndvi_array[0, 0], 0.13513513513513514, 5, "NDVI calculation is broken.")
+        self.assertTrue(np.isnan(ndvi_array[0, 1]), "Nodata pixel has not been masked.")
+
+    def test_get_ndvi_masked_array(self):
+        '''
+        Test NDVI calculation on masked bands, masked
+        pixels have to be NaN in the result
+        '''
+        nir = np.ma.masked_array([[42, 100]], mask=[[False, True]], dtype=np.int16)
+        red = np.ma.masked_array([[32, 0]], mask=[[False, False]], dtype=np.int16)
+        ndvi_array = ndvicalc._get_ndvi(nir, red)
+        self.assertNotIsInstance(ndvi_array, np.ma.MaskedArray, "NDVI array is still masked.")
+        self.assertAlmostEqual(ndvi_array[0, 0], 0.13513513513513514, 5, "NDVI calculation is broken.")
+        self.assertTrue(np.isnan(ndvi_array[0, 1]), "Masked pixel is not NaN.")
+
+    def test_ndvi_stats(self):
+        '''
+        Test the fused NDVI & statistics kernel, NaN values
+        have to be ignored
+        '''
+        nir = np.array([[3.0, np.nan, 3.0], [1.0, 0.0, 2.0]], dtype=np.float32)
+        red = np.array([[1.0, 1.0, 5.0], [0.0, 0.0, 2.0]], dtype=np.float32)
+        out = np.empty_like(nir)
+        count, total, total_sq, minimum, maximum = _ndvi_stats(nir, red, out)
+        np.testing.assert_allclose(out, ndvicalc._get_ndvi(nir, red), err_msg="NDVI differs from _get_ndvi.")
+        self.assertEqual(count, 4, "NaN values are counted.")
+        self.assertAlmostEqual(total, 1.25, 5, "Sum is wrong.")
+        self.assertAlmostEqual(total_sq, 1.3125, 5, "Sum of squares is wrong.")
+        self.assertEqual((minimum, maximum), (-0.25, 1.0), "Min or max is wrong.")
+
+    def test_downsample(self):
+        '''
+        Test block averaging of the NDVI array used for plotting
+        '''
+        array = np.arange(16, dtype=np.float32).reshape(4, 4)
+        array[0, 0] = np.nan
+        array[2:, 2:] = np.nan
+        small = ndvicalc._downsample(array, 2)
+        self.assertEqual(small.shape, (2, 2), "Downsampled shape is wrong.")
+        self.assertAlmostEqual(small[0, 0], 10/3, 5, "NaN values are not ignored.")
+        self.assertAlmostEqual(small[1, 0], 10.5, 5, "Block average is wrong.")
+        self.assertTrue(np.isnan(small[1, 1]), "Empty block is not NaN.")
+
+    def test_read_block_nodata(self):
+        '''
+        Tests that nodata pixels and pixels outside
+        of the geometry are read as NaN
+        '''
+        data = np.array([[0, 100], [200, 300]], dtype=np.uint16)
+        transform = from_origin(0, 20, 10, 10)
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff", height=2, width=2, count=1, dtype="uint16", 
+                crs="EPSG:32633", transform=transform, nodata=0
+                ) as dataset:
+                dataset.write(data, 1)
+            with memfile.open() as dataset:
+                # geometry covers all but the lower right pixel
+                shapes = [{"type": "Polygon", "coordinates": [[(0, 20), (20, 20), (20, 10), (10, 10), (10, 0), (0, 0), (0, 20)]]}]
+                band = ndvicalc._read_block(dataset, Window(0, 0, 2, 2), (2, 2), shapes)
+        self.assertEqual(band.dtype, np.float32, "Band is not float32.")
+        self.assertTrue(np.isnan(band[0, 0]), "Nodata pixel is not NaN.")
+        self.assertTrue(np.isnan(band[1, 1]), "Pixel outside of geometry is not NaN.")
+        self.assertEqual(band[0, 1], 100, "Valid pixel was changed.")
+
+    def test_get_read_window_outside(self):
+        '''
+        Test if NDVIError is raised when the geometry
+        extends the dataset
+        '''
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff", height=10, width=10, count=1, dtype="uint16", 
+                crs="EPSG:4326", transform=from_origin(13.0, 52.5, 0.01, 0.01)
+                ) as dataset:
+                geometry = {"type": "Polygon", "coordinates": [[(13.05, 52.45), (13.15, 52.45), (13.15, 52.35), (13.05, 52.35), (13.05, 52.45)]]}
+                with self.assertRaises(NDVIError):
+                    ndvicalc._get_read_window(dataset, geometry)
+
+    def test_materialize_ndvi_closes_band(self):
+        '''
+        Tests that an opened band is closed when
+        the other band can not be opened
+        '''
+        calc = NDVICalc()
+        opened = []
+        open_band = calc._open_band
+        def record_open(url):
+            dataset = open_band(url)
+            opened.append(dataset)
+            return dataset
+        with TemporaryDirectory() as directory:
+            red_path = os.path.join(directory, "red.tif")
+            with rasterio.open(
+                red_path, "w", driver="GTiff", height=2, width=2, count=1, 
+                dtype="uint16", crs="EPSG:32633", transform=from_origin(0, 20, 10, 10)
+                ) as dataset:
+                dataset.write(np.ones((1, 2, 2), dtype=np.uint16))
+            files = {"nir": os.path.join(directory, "missing.tif"), "red": red_path}
+            with mock.patch.object(calc, "get_latest_sentinel_files", return_value=files), \
+                mock.patch.object(calc, "_open_band", side_effect=record_open):
+                with self.assertRaises(rasterio.errors.RasterioIOError):
+                    calc.calc_ndvi(EXAMPLE_PATH)
+        self.assertEqual(len(opened), 1, "Red band was not opened.")
+        self.assertTrue(opened[0].closed, "Red band was not closed.")
+
+    def test_iter_blocks(self):
+        '''
+        Test that the blocks cover the output array exactly
+        once and start on the tile grid of the COG
+        '''
+        window = Window(100, 700, 1500, 1100)
+        for factor in (1, 2, 3):
+            covered = np.zeros((1100 // factor, 1500 // factor), dtype=int)
+            for rows, cols, block in ndvicalc._iter_blocks(window, factor, (512, 512)):
+                covered[rows, cols] += 1
+                # the tile grid is met up to less than one output pixel
+                if rows.start > 0:
+                    self.assertLess(-block.row_off % (512 * factor), factor, "Block is not aligned.")
+                if cols.start > 0:
+                    self.assertLess(-block.col_off % (512 * factor), factor, "Block is not aligned.")
+            self.assertTrue((covered == 1).all(), "Blocks do not cover the window once.")
+
+    def test_accumulate_block(self):
+        '''
+        Test that block averaging unaligned blocks
+        matches averaging the whole array
+        '''
+        array = np.random.default_rng(0).uniform(-1, 1, (7, 10)).astype(np.float32)
+        array[0, :4] = np.nan
+        sums = np.zeros((3, 4))
+        counts = np.zeros((3, 4), dtype=np.int32)
+        for rows, cols in ((slice(0, 5), slice(0, 7)), (slice(0, 5), slice(7, 10)), (slice(5, 7), slice(0, 10))):
+            ndvicalc._accumulate_block(sums, counts, array[rows, cols], rows, cols, 3)
+        padded = np.full((9, 12), np.nan, dtype=np.float32)
+        padded[:7, :10] = array
+        expected = np.nanmean(padded.reshape(3, 3, 4, 3), axis=(1, 3))
+        np.testing.assert_allclose(sums / counts, expected, rtol=1e-5, err_msg="Block average is wrong.")
+
+    def test_get_read_window_factor(self):
+        '''
+        Test that large areas are read at full resolution,
+        only target_resolution selects the overviews
+        '''
+        calc = NDVICalc()
+        calc.MAX_PIXELS = 10
+        with MemoryFile() as memfile:
+            with memfile.open(
+                driver="GTiff", height=1000, width=1000, count=1, dtype="uint16", 
+                crs="EPSG:32633", transform=from_origin(380000, 5825000, 10, 10)
+                ) as dataset:
+                geometry = {"type": "Polygon", "coordinates": [[(13.25, 52.53), (13.3, 52.53), (13.3, 52.5), (13.25, 52.53)]]}
+                _, window, factor = calc._get_read_window(dataset, geometry)
+                self.assertGreater(max(window.width, window.height), calc.MAX_PIXELS)
+                self.assertEqual(factor, 1, "Statistics are not read at full resolution.")
+                _, _, factor = calc._get_read_window(dataset, geometry, 40.0)
+                self.assertEqual(factor, 4, "Target resolution is ignored.")
+
+    def test_get_latest_sentinel_files_empty(self):
+        '''
+        Tests that NDVIError is raised when no scene
+        is found for the geometry
+        '''
+        calc = NDVICalc()
+        with TemporaryDirectory() as directory, mock.patch("ndvi.Search.query") as query:
+            calc.CACHE_DIR = directory
+            query.return_value = {"context": {"matched": 0}, "features": [], "links": []}
+            with self.assertRaises(NDVIError):
+                calc.get_latest_sentinel_files({"type": "Point", "coordinates": [13.0, 52.5]})
+
+    def test_get_latest_sentinel_files_cache(self):
+        '''
+        Tests that searches are answered from the disk cache
+        within CACHE_TTL and searched again when the entry is
+        expired or corrupt
+        '''
+        calc = NDVICalc()
+        geometry = {"type": "Point", "coordinates": [13.0, 52.5]}
+        expected = {"red": "https://example.com/red.tif", "nir": "https://example.com/nir.tif"}
+        feature = {
+            "type": "Feature",
+            "id": "S2A_33UUU_20210814_0_L2A",
+            "properties": {"datetime": "2021-08-14T10:20:00Z"},
+            "assets": {band: {"href": href} for band, href in expected.items()}
+            }
+        with TemporaryDirectory() as directory, mock.patch("ndvi.Search.query") as query:
+            calc.CACHE_DIR = directory
+            # more matches than the limit of 1, as for every real search
+            query.return_value = {"context": {"matched": 42}, "features": [feature], "links": []}
+            with self.assertNoLogs("satsearch", level="WARNING"):
+                self.assertEqual(calc.get_latest_sentinel_files(geometry), expected)
+            self.assertEqual(query.call_count, 1, "Search needs more than one request.")
+            cache_file = os.path.join(directory, os.listdir(directory)[0])
+
+            # hit within CACHE_TTL
+            calc.latest_data = None
+            self.assertEqual(calc.get_latest_sentinel_files(geometry), expected)
+            self.assertEqual(query.call_count, 1, "Cache entry was not used.")
+            self.assertEqual(calc.latest_data, date(2021, 8, 14), "Cached date is wrong.")
+
+            # miss after expiry, an unrelated expired entry is removed
+            expired = time.time() - calc.CACHE_TTL - 1
+            os.utime(cache_file, (expired, expired))
+            old_file = os.path.join(directory, "old.json")
+            with open(old_file, "w") as fp:
+                fp.write("{}")
+            os.utime(old_file, (expired, expired))
+            self.assertEqual(calc.get_latest_sentinel_files(geometry), expected)
+            self.assertEqual(query.call_count, 2, "Expired entry was used.")
+            self.assertFalse(os.path.exists(old_file), "Expired entry was not removed.")
+            self.assertTrue(os.path.exists(cache_file), "New entry was removed.")
+
+            # corrupt entry falls back to a live search
+            with open(cache_file, "w") as fp:
+                fp.write("{not json")
+            self.assertEqual(calc.get_latest_sentinel_files(geometry), expected)
+            self.assertEqual(query.call_count, 3, "Corrupt entry was used.")
+
     def test_get_latest_sentinel_files(self):
         '''
         Tests if valid URLs are returned for a given
@@ -60,26 +335,21 @@ class TestNDVICalc(unittest.TestCase):
             file_content = json.load(fp)
             geometry = file_content["features"][0]["geometry"]
 
+        # an empty cache, so the live search is tested even after test_calc_ndvi
+        ndvicalc.CACHE_DIR = mkdtemp(dir=cache_directory.name)
         file_urls = ndvicalc.get_latest_sentinel_files(geometry)
-        regex = re.compile(  # credit: django https://github.com/django/django/blob/stable/1.3.x/django/core/validators.py#L45
-            r'^(?:http|ftp)s?://' # http:// or https://
-            r'(?:(?:[A-Z0-9](?:[A-Z0-9-]{0,61}[A-Z0-9])?\.)+(?:[A-Z]{2,6}\.?|[A-Z0-9-]{2,}\.?)|' #domain...
-            r'localhost|' #localhost...
-            r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})' # ...or ip
-            r'(?::\d+)?' # optional port
-            r'(?:/?|[/?]\S+)$', re.IGNORECASE)
-        self.assertRegex(file_urls["red"], regex, "Red band url is corrupt.")
-        self.assertRegex(file_urls["nir"], regex, "Nir band url is corrupt.")
+        self.assertRegex(file_urls["red"], URL_RE, "Red band url is corrupt.")
+        self.assertRegex(file_urls["nir"], URL_RE, "Nir band url is corrupt.")
 
     def test_calc_ndvi(self):
         '''
         Tests if values for NDVI avg, max, min, std are set
         and plausible. 
         '''
-        ndvicalc.calc_ndvi(EXAMPLE_PATH)
+        ndvicalc.calc_ndvi(EXAMPLE_PATH, keep_array=True)
         self.assertNotEqual(ndvicalc.ndvi_avg, None, "Avg NDVI could not be generated")
 
-        ndvi_array = list(ndvicalc.ndvi_array.compressed().flatten())
+        ndvi_array = list(ndvicalc.ndvi_array[~np.isnan(ndvicalc.ndvi_array)])
         self.assertTrue(all([1 >= i >= -1 for i in ndvi_array]), "Invalid values >1 or <-1 found.")
 
         # test full statistics flag
@@ -88,6 +358,59 @@ class TestNDVICalc(unittest.TestCase):
         self.assertNotEqual(ndvicalc.ndvi_min, None, "Min NDVI could not be generated")
         self.assertNotEqual(ndvicalc.ndvi_std, None, "Std NDVI could not be generated")
 
+    def test_calc_ndvi_reuses_result(self):
+        '''
+        Tests that calling calc_ndvi again for the same
+        file does not compute the NDVI a second time
+        '''
+        calc = NDVICalc()
+        def materialize(file_path, keep_array, target_resolution_m, silent):
+            calc.ndvi_array = np.zeros((2, 2), dtype=np.float32) if keep_array else None
+        with mock.patch.object(calc, "_materialize_ndvi", side_effect=materialize) as materialize_mock:
+            calc.calc_ndvi(EXAMPLE_PATH)
+            calc.calc_ndvi(EXAMPLE_PATH, full_statistics=True)
+            self.assertEqual(materialize_mock.call_count, 1, "NDVI was computed twice")
+            calc.calc_ndvi(EXAMPLE_PATH, keep_array=True)
+            self.assertEqual(materialize_mock.call_count, 2, "Missing NDVI array was not computed")
+
+    def test_calc_ndvi_save_path(self):
+        '''
+        Tests that the NDVI is saved as grayscale PNG,
+        NaN values are black
+        '''
+        calc = NDVICalc()
+        def materialize(file_path, keep_array, target_resolution_m, silent):
+            calc.ndvi_array = np.array([[-1.0, 0.0], [1.0, np.nan]], dtype=np.float32)
+        with mock.patch.object(calc, "_materialize_ndvi", side_effect=materialize), \
+            TemporaryDirectory() as directory:
+            save_path = os.path.join(directory, "ndvi.png")
+            calc.calc_ndvi(EXAMPLE_PATH, save_path=save_path)
+            with Image.open(save_path) as image:
+                pixels = np.asarray(image)
+        self.assertEqual(pixels.tolist(), [[1, 128], [255, 0]], "PNG pixel values are wrong.")
+
+    def test_cli_paths_file(self):
+        '''
+        Tests that the CLI batch mode skips a corrupt
+        geoJSON and exits once its workers are done
+        '''
+        with TemporaryDirectory() as directory:
+            paths_file = os.path.join(directory, "paths.txt")
+            with open(paths_file, "w") as fp:
+                fp.write(CORRUPT_PATH + "\n")
+                fp.write("./example/missing.geojson\n")
+            result = subprocess.run(
+                [sys.executable, str(package_root_directory / "ndvi.py"), "--paths-file", paths_file],
+                capture_output=True,
+                text=True,
+                timeout=60
+                )
+        self.assertEqual(result.returncode, 0, "Batch mode failed.")
+        lines = result.stdout.splitlines()
+        self.assertEqual(len(lines), 2, "Batch mode does not print one line per file.")
+        self.assertTrue(lines[0].startswith(f"{CORRUPT_PATH}, skipped: "), "Corrupt file was not skipped.")
+        self.assertTrue(lines[1].startswith("./example/missing.geojson, skipped: "), "Missing file was not skipped.")
+
 
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
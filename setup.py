@@ -12,11 +12,18 @@ setup(
         'Click',
         'rasterio',
         'matplotlib',
+        'pillow',
         'numpy',
         'pyproj',
+        'shapely>=2.0',
         'sat-search',
-        'requests'
+        'sat-stac',
+        'requests',
+        'numba'
     ],
+    extras_require={
+        'orjson': ['orjson'],
+    },
     entry_points={
         'console_scripts': [
             'ndvicalc = ndvicalc.ndvi:cli',